@@ -1,16 +1,26 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, Response, send_file, abort
 import os
+import ast
+import asyncio
+import re
+import threading
+import uuid
+import functools
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor
 import openai
+import orjson
 import traceback
 import numpy as np
 import pandas as pd
 import io
-import base64
 from datetime import datetime, timedelta
+from typing import Optional
 import yfinance as yf
 import vectorbt as vbt
-import matplotlib.pyplot as plt
+from numba import njit, types
 from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib
 from dotenv import load_dotenv
 
@@ -26,26 +36,186 @@ pd.set_option('future.no_silent_downcasting', True)
 
 app = Flask(__name__)
 
+YF_CACHE_DIR = './_yf_cache'
+
+# Background pool for benchmark downloads that overlap code generation in the main backtest
+_download_pool = ThreadPoolExecutor(max_workers=3)
+
+# yf.download keeps its results in module-global state (yfinance.shared), so concurrent calls
+# clobber each other; only one download may run at a time in this process
+_yf_download_lock = threading.Lock()
+
+# Rendered plot PNGs served by /plot/<pid>; kept on disk so every server worker can serve them,
+# oldest files pruned first
+PLOT_CACHE_DIR = './_plot_cache'
+PLOT_CACHE_SIZE = 32
+_PLOT_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+@functools.lru_cache(maxsize=1)
+def _load_tickers(csv_path='ind_nifty500list.csv'):
+    """Read the Nifty 500 list once and return the .NS-suffixed tickers"""
+    df = pd.read_csv(csv_path)
+    s = df['Symbol'].dropna().astype(str).str.upper().unique()
+    return tuple(np.where(pd.Series(s).str.endswith('.NS'), s, s + '.NS'))
+
+def _is_fresh(path):
+    """True if a cache file exists and was written today"""
+    return (
+        os.path.exists(path)
+        and datetime.fromtimestamp(os.path.getmtime(path)).date() == datetime.now().date()
+    )
+
+def _cached_download(tickers, period, interval, field=None, **kwargs):
+    """yf.download backed by a parquet file that is reused for the rest of the day.
+
+    With ``field`` (e.g. 'Close') only that column of a group_by='ticker' download is kept and cached.
+    """
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    key = repr((tuple(tickers), period, interval, field, sorted(kwargs.items())))
+    path = os.path.join(YF_CACHE_DIR, hashlib.md5(key.encode('utf-8')).hexdigest() + '.parquet')
+    if _is_fresh(path):
+        return pd.read_parquet(path)
+
+    with _yf_download_lock:
+        # Another thread may have fetched the same data while this one waited for the lock
+        if _is_fresh(path):
+            return pd.read_parquet(path)
+        data = yf.download(
+            tickers if len(tickers) > 1 else tickers[0],
+            period=period,
+            interval=interval,
+            threads=True,
+            progress=False,
+            **kwargs
+        )
+        # yfinance returns empty/NaN frames instead of raising; don't pin a failed download for the day
+        if data.empty:
+            return data
+        if field is not None:
+            data = data.xs(field, axis=1, level=1)
+        selected = data if field is not None else data.get('Close', data)
+        if not selected.notna().to_numpy().any():
+            return data
+
+        # Write to a temp file and swap it in so lock-free readers never see a partial parquet
+        os.makedirs(YF_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        data.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+    return data
+
+def _close_series(data, symbol):
+    """Close prices from a single-symbol download, with a clear error when yfinance returned nothing"""
+    if data.empty or 'Close' not in data:
+        raise RuntimeError(f"No price data returned for {symbol}; Yahoo Finance may be unavailable, try again later.")
+    return data['Close']
+
+# First line containing a common explanation pattern; everything from there on is dropped
+_EXPL_RE = re.compile(r'(?im)^.*(this code|the above|explanation:|note:).*$')
+_FENCE_RE = re.compile(r'^```(?:python)?\n?|\n?```$')
+
 def clean_generated_code(code_str):
     """Clean and validate generated code from OpenAI"""
     # Remove markdown code blocks
-    if code_str.startswith('```python'):
-        code_str = code_str[9:]
-    if code_str.startswith('```'):
-        code_str = code_str[3:]
-    if code_str.endswith('```'):
-        code_str = code_str[:-3]
+    code_str = _FENCE_RE.sub('', code_str.strip())
     
     # Remove any explanatory text after the code
-    lines = code_str.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        # Stop at common explanation patterns
-        if any(phrase in line.lower() for phrase in ['this code', 'the above', 'explanation:', 'note:']):
-            break
-        cleaned_lines.append(line)
+    m = _EXPL_RE.search(code_str)
+    if m:
+        code_str = code_str[:m.start()]
     
-    return '\n'.join(cleaned_lines).strip()
+    return code_str.strip()
+
+class _CodeRuleChecker(ast.NodeVisitor):
+    """Collect violations of the prompt rules that can be detected without running the code"""
+
+    def __init__(self):
+        self.violations = []
+
+    def visit_For(self, node):
+        self.violations.append(f"line {node.lineno}: for loops are not allowed - use vectorized pandas operations")
+        self.generic_visit(node)
+
+    def visit_While(self, node):
+        self.violations.append(f"line {node.lineno}: while loops are not allowed - use vectorized pandas operations")
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if node.attr == 'at':
+            self.violations.append(f"line {node.lineno}: .at[] indexing is not allowed - use boolean masking instead")
+        elif node.attr == 'download' and isinstance(node.value, ast.Name) and node.value.id == 'yf':
+            self.violations.append(f"line {node.lineno}: yf.download is not allowed - use the preloaded close and idx_close")
+        self.generic_visit(node)
+
+def validate_generated_code(code_str):
+    """Parse generated code and reject rule violations before it is executed"""
+    tree = ast.parse(code_str)
+    checker = _CodeRuleChecker()
+    checker.visit(tree)
+    if checker.violations:
+        raise ValueError("Generated code breaks the rules:\n" + "\n".join(checker.violations))
+
+# Compiled eagerly (and cached on disk) so no request pays for the JIT; read-only inputs also accept
+# writable arrays. Serial on purpose: it is called from concurrent request threads, and Numba's default
+# workqueue threading layer aborts the process on concurrent parallel launches.
+_EXIT_SIG = types.boolean[:, ::1](
+    types.Array(types.float64, 2, 'A', readonly=True),
+    types.Array(types.boolean, 2, 'A', readonly=True),
+    types.float64,
+    types.float64
+)
+
+@njit(_EXIT_SIG, cache=True)
+def compute_exits(close_arr, entries_arr, tp, sl):
+    """Profit target / stop loss exit mask, equivalent to close.where(entries).ffill() checks"""
+    n_rows, n_cols = close_arr.shape
+    exits = np.zeros((n_rows, n_cols), dtype=np.bool_)
+    for col in range(n_cols):
+        entry_price = np.nan
+        for i in range(n_rows):
+            price = close_arr[i, col]
+            if entries_arr[i, col] and not np.isnan(price):
+                entry_price = price
+            exits[i, col] = price >= entry_price * (1 + tp) or price <= entry_price * (1 - sl)
+    return exits
+
+async def _generate_code_async(prompt):
+    """Request a completion and return the cleaned code string"""
+    resp = await openai.ChatCompletion.acreate(
+        model="o4-mini",
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return clean_generated_code(resp.choices[0].message.content)
+
+def _speculative_codes(prompts):
+    """Request completions concurrently and yield each cleaned code string as soon as it arrives.
+
+    Closing the generator cancels any completions still in flight.
+    """
+    loop = asyncio.new_event_loop()
+    pending = {loop.create_task(_generate_code_async(p)) for p in prompts}
+    errors = []
+    yielded = False
+    try:
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                yielded = True
+                yield task.result()
+        if not yielded and errors:
+            raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
 
 def auto_backtest(
     user_prompt: str,
@@ -54,7 +224,8 @@ def auto_backtest(
     size: float = 0.2,
     period: str = "24mo",
     interval: str = "1d",
-    max_retries: int = 3
+    max_retries: int = 3,
+    idx_future: Optional[Future] = None
 ) -> vbt.Portfolio:
     # Configure OpenAI
     openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -74,13 +245,15 @@ CRITICAL RULES:
 7. Use standard operators (+ - * /) instead of .div() .mul() on literals
 
 DATA STRUCTURE:
-`raw` is a multi-level DataFrame from yfinance. Extract data like this:
-close = raw.xs('Close', axis=1, level=1)
+`close` is already defined (float32 closing prices, one column per ticker) - do not recompute it.
+`idx_close` is already defined (Nifty 500 index closing prices, aligned to close.index) - do not download it.
+`compute_exits(close_arr, entries_arr, tp, sl)` is already defined - returns a boolean exit array for a
+fractional profit target `tp` and stop loss `sl`. Pass a float64 close array and a boolean entries array:
+close.to_numpy(dtype=np.float64) and entries.to_numpy(dtype=bool) (close itself is float32 and is rejected).
 
-REQUIREMENTS - Create these 3 variables:
-1. close: Price DataFrame
-2. entries: Boolean DataFrame (same shape as close) 
-3. exits: Boolean DataFrame (same shape as close)
+REQUIREMENTS - Create these 2 variables:
+1. entries: Boolean DataFrame (same shape as close) 
+2. exits: Boolean DataFrame (same shape as close)
 
 SHAPE SAFETY RULES:
 # After creating entries/exits, ALWAYS add these lines to ensure correct shape:
@@ -89,9 +262,6 @@ exits = exits.reindex(index=close.index, columns=close.columns, fill_value=False
 
 WORKING EXAMPLES:
 
-# Basic pattern - ALWAYS start with this:
-close = raw.xs('Close', axis=1, level=1)
-
 # Example 1: Simple MA crossover
 sma_short = close.rolling(10).mean()
 sma_long = close.rolling(20).mean()
@@ -113,8 +283,7 @@ entries = entries.reindex(index=close.index, columns=close.columns, fill_value=F
 exits = exits.reindex(index=close.index, columns=close.columns, fill_value=False)
 
 # Example 3: Index filter (Nifty above 200 EMA) - SAFE METHOD
-idx_data = yf.download('^CRSLDX', period='24mo', interval='1d', progress=False)
-idx_close = idx_data['Close'].reindex(close.index).ffill()
+# idx_close is preloaded - use it directly
 idx_ema200 = idx_close.ewm(span=200).mean()
 bullish_days = idx_close > idx_ema200
 # Create base conditions first
@@ -128,12 +297,10 @@ exits = cross_up.multiply(~bullish_days, axis=0)  # Exit when index turns bearis
 entries = entries.reindex(index=close.index, columns=close.columns, fill_value=False)
 exits = exits.reindex(index=close.index, columns=close.columns, fill_value=False)
 
-# Example 4: Profit target/Stop loss (VECTORIZED - NO LOOPS!)
+# Example 4: Profit target/Stop loss (use the preloaded compute_exits - NO LOOPS!)
 # For 5% profit target, 5% stop loss:
-entry_price = close.where(entries).ffill()
-target_hit = close >= entry_price * 1.05
-stop_hit = close <= entry_price * 0.95
-exits = target_hit | stop_hit
+exits_arr = compute_exits(close.to_numpy(dtype=np.float64), entries.to_numpy(dtype=bool), 0.05, 0.05)
+exits = pd.DataFrame(exits_arr, index=close.index, columns=close.columns)
 # ALWAYS add shape fixing:
 exits = exits.reindex(index=close.index, columns=close.columns, fill_value=False)
 
@@ -160,41 +327,53 @@ IMPORTANT: Ensure trades can be closed properly:
 # For strategies with index filters, make sure exits are not overly restrictive
 # Example: If entry requires bullish market, exit should trigger in bearish OR profit/stop conditions
 
-CRITICAL INDEX SYMBOL: Use '^CRSLDX' for Nifty 500 index data (NOT ^NSE500 or other symbols)
+CRITICAL INDEX DATA: Use the preloaded `idx_close` for Nifty 500 index data (NEVER call yf.download)
 
 USER STRATEGY: "{user_prompt}"
 
 Generate ONLY the code (no explanations, no markdown):'''
 
     # Load stock data
-    csv_path = 'ind_nifty500list.csv'
-    df = pd.read_csv(csv_path)
-    raw_syms = df['Symbol'].dropna().astype(str).str.upper().unique()
-    tickers = [sym if sym.endswith('.NS') else f"{sym}.NS" for sym in raw_syms]
-    raw = yf.download(
+    tickers = list(_load_tickers())
+    # Strategies only use closing prices, so only Close is kept (and cached), downcast to float32
+    close_pre = _cached_download(
         tickers,
-        period=period,
-        interval=interval,
+        period,
+        interval,
+        field='Close',
         group_by="ticker",
-        progress=False
-    )
+        auto_adjust=True,
+        actions=False
+    ).astype(np.float32)
+
+    # Nifty 500 index close, shared with the chart benchmark when a pending download is passed in
+    if idx_future is not None:
+        idx_data = idx_future.result()
+    else:
+        idx_data = _cached_download('^CRSLDX', period, interval)
+    idx_close = _close_series(idx_data, '^CRSLDX').reindex(close_pre.index, method='ffill')
 
     code_str = None
     last_error = ""
-    env = {"raw": raw}
     preloaded_globals = {
         "__builtins__": __builtins__,  # give it access to builtins like range, len, etc.
         "pd": pd,
         "yf": yf,
         "vbt": vbt,
-        "np": np
+        "np": np,
+        "idx_close": idx_close,
+        "compute_exits": compute_exits
         # add any other names you expect GPT to use…
     }
 
+    # Speculatively request the first attempts in parallel; later candidates only run if earlier ones fail
+    speculative_codes = _speculative_codes([base_prompt] * min(2, max_retries))
+
     for attempt in range(1, max_retries + 1):
         # Get (or re-get) the code from OpenAI
-        if code_str is None:
-            prompt = base_prompt
+        next_code = next(speculative_codes, None)
+        if next_code is not None:
+            code_str = next_code
         else:
             # on retry, include last code + error
             prompt = (
@@ -209,27 +388,30 @@ Generate ONLY the code (no explanations, no markdown):'''
             )
             print(prompt)
         
-        resp = openai.ChatCompletion.create(
-            model="o4-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        code_str = resp.choices[0].message.content
-        
-        # Clean the generated code
-        code_str = clean_generated_code(code_str)
+            resp = openai.ChatCompletion.create(
+                model="o4-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
+            code_str = resp.choices[0].message.content
+            
+            # Clean the generated code
+            code_str = clean_generated_code(code_str)
         
         # Debug: Print the cleaned code
         print(f"\n--- Attempt {attempt} Generated Code ---")
         print(code_str)
         print("--- End Generated Code ---\n")
 
-        # Try to exec it
+        # Try to exec it; each attempt gets its own copy so in-place edits can't leak into later attempts
+        env = {"close": close_pre.copy()}
         try:
+            # Reject unparsable or rule-breaking code without running it
+            validate_generated_code(code_str)
             exec(code_str, preloaded_globals, env)
 
             # Validate that required variables exist
-            if "close" not in env or "entries" not in env or "exits" not in env:
-                raise ValueError("Generated code must define 'close', 'entries', and 'exits' variables")
+            if "entries" not in env or "exits" not in env:
+                raise ValueError("Generated code must define 'entries' and 'exits' variables")
 
             # Pull out the variables GPT defined
             close = env["close"]
@@ -269,7 +451,8 @@ Generate ONLY the code (no explanations, no markdown):'''
                 cash_sharing=True
             )
 
-            # Success — return the portfolio immediately
+            # Success — cancel any speculative completion still running and return the portfolio
+            speculative_codes.close()
             return pf
 
         except Exception as e:
@@ -280,31 +463,35 @@ Generate ONLY the code (no explanations, no markdown):'''
             elif "KeyError" in error_str and "None of" in error_str:
                 last_error = f"Indexing error: {error_str}\nAvoid using .loc[] with boolean series directly. Use .multiply() method instead for applying conditions across DataFrame."
             elif "YFPricesMissingError" in error_str or "No data found" in error_str:
-                last_error = f"Invalid ticker symbol: {error_str}\nUse '^CRSLDX' for Nifty 500 index data, not other symbols."
-            elif "SyntaxError" in error_str:
+                last_error = f"Market data download failed: {error_str}\nDo not download data - use the preloaded `close` and `idx_close` (Nifty 500 index) instead."
+            elif isinstance(e, SyntaxError) or "SyntaxError" in error_str:
                 last_error = f"Python syntax error: {error_str}\nCheck for invalid method calls on literals (e.g., use (100).div() not 100.div()) or use standard operators like / instead of .div()"
             else:
                 last_error = f"Error: {error_str}"
             
-            full_traceback = traceback.format_exc()
-            print(f"Attempt {attempt} failed with error:\n{full_traceback}")
+            # Formatting the traceback is costly with deep vectorbt stacks; only do it when it will be read
+            if attempt == max_retries or os.getenv("DEBUG"):
+                full_traceback = traceback.format_exc()
+                print(f"Attempt {attempt} failed with error:\n{full_traceback}")
+            else:
+                print(f"Attempt {attempt} failed with error: {type(e).__name__}: {error_str}")
             if attempt == max_retries:
                 # If all attempts failed, try a simple fallback strategy
                 print("All AI attempts failed. Using simple fallback strategy...")
                 try:
                     # Simple moving average crossover as fallback
                     fallback_code = '''
-close = raw.xs('Close', axis=1, level=1)
 # Simple buy and hold strategy - very basic fallback
 entries = pd.DataFrame(False, index=close.index, columns=close.columns)
 exits = pd.DataFrame(False, index=close.index, columns=close.columns)
 # Buy on first day, never sell (simple buy and hold)
 entries.iloc[10] = True  # Buy after 10 days to avoid initial NaN issues
 '''
+                    env = {"close": close_pre.copy()}
                     exec(fallback_code, preloaded_globals, env)
                     
                     # Validate fallback worked
-                    if "close" in env and "entries" in env and "exits" in env:
+                    if "entries" in env and "exits" in env:
                         close = env["close"]
                         entries = env["entries"]
                         exits = env["exits"]
@@ -339,19 +526,108 @@ entries.iloc[10] = True  # Buy after 10 days to avoid initial NaN issues
 
     return None
 
-def fig_to_base64(fig):
-    """Convert a matplotlib figure to base64 string for HTML display"""
+# One Figure/canvas per thread, reused for both plots of a request. The rasterizer is only reused across
+# requests when threads are long-lived (gunicorn gthread workers); the dev server started by
+# `python app.py` spawns a new thread per request, so there it is allocated once per request.
+_fig_local = threading.local()
+
+def _get_fig():
+    """Return this thread's cleared Figure and its Agg canvas"""
+    fig = getattr(_fig_local, 'fig', None)
+    if fig is None:
+        fig = Figure(figsize=(12, 6))
+        _fig_local.fig = fig
+        _fig_local.canvas = FigureCanvasAgg(fig)
+    fig.clear()
+    return fig, _fig_local.canvas
+
+def fig_to_png(series, title, color=None):
+    """Plot a series on this thread's Agg canvas and return the PNG bytes"""
+    fig, canvas = _get_fig()
+    ax = fig.subplots()
+    # Plot raw arrays so pandas' plotting layer and unit converters are bypassed
+    ax.plot(series.index.values, np.asarray(series).squeeze(), color=color)
+    ax.set_title(title)
+    ax.grid(True)
+    fig.tight_layout()
     buf = io.BytesIO()
-    fig.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
+    canvas.print_png(buf)
+    png_bytes = buf.getvalue()
     buf.close()
-    return img_str
+    return png_bytes
+
+def store_plot(png_bytes):
+    """Write a rendered PNG to the plot cache and return the URL it is served from"""
+    pid = uuid.uuid4().hex
+    os.makedirs(PLOT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(PLOT_CACHE_DIR, pid + '.png')
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, 'wb') as f:
+        f.write(png_bytes)
+    os.replace(tmp_path, path)
+
+    # Prune the oldest plots; another worker may already have removed some of them
+    plots = []
+    for entry in os.scandir(PLOT_CACHE_DIR):
+        if entry.name.endswith('.png'):
+            try:
+                plots.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    plots.sort()
+    for _, old_path in plots[:-PLOT_CACHE_SIZE]:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+    return f"/plot/{pid}"
+
+def _json_default(obj):
+    """Serialize values orjson doesn't handle natively (e.g. pandas Timestamps)"""
+    if isinstance(obj, pd.Timestamp):
+        return None if pd.isna(obj) else obj.isoformat()
+    raise TypeError
+
+def frame_to_fragment(df):
+    """Serialize a DataFrame column-wise as {'columns': [...], 'data': [column values, ...]} without per-row dicts"""
+    data = []
+    for _, col in df.items():
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biuf':
+            data.append(np.ascontiguousarray(col.to_numpy()))
+        elif isinstance(col.dtype, np.dtype) and col.dtype.kind == 'M':
+            # orjson writes NaT as a bogus date, so open trades get null exit timestamps instead
+            data.append(col.dt.strftime('%Y-%m-%dT%H:%M:%S').where(col.notna(), None).tolist())
+        else:
+            data.append(col.tolist())
+    return orjson.Fragment(orjson.dumps(
+        {'columns': df.columns.tolist(), 'data': data},
+        default=_json_default,
+        option=orjson.OPT_SERIALIZE_NUMPY
+    ))
+
+def json_response(payload, status=200):
+    """Build a JSON response with orjson, passing numpy arrays and scalars through as-is"""
+    body = orjson.dumps(
+        payload,
+        default=_json_default,
+        option=orjson.OPT_SERIALIZE_NUMPY
+    )
+    return Response(body, status=status, mimetype='application/json')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/plot/<pid>')
+def plot(pid):
+    if not _PLOT_ID_RE.fullmatch(pid):
+        abort(404)
+    path = os.path.abspath(os.path.join(PLOT_CACHE_DIR, pid + '.png'))
+    try:
+        return send_file(path, mimetype='image/png')
+    except FileNotFoundError:
+        abort(404)
+
 @app.route('/backtest', methods=['POST'])
 def backtest():
     data = request.json
@@ -360,11 +636,12 @@ def backtest():
     size = float(data.get('size', 0.1))
     
     try:
+        # Start fetching benchmark data (Nifty 50 and Nifty 500) while the strategy runs
+        nifty50_future = _download_pool.submit(_cached_download, '^NSEI', '24mo', '1d')
+        nifty500_future = _download_pool.submit(_cached_download, '^CRSLDX', '24mo', '1d')
+
         # Get tickers from CSV
-        csv_path = 'ind_nifty500list.csv'
-        df = pd.read_csv(csv_path)
-        raw_syms = df['Symbol'].dropna().astype(str).str.upper().unique()
-        tickers = [sym if sym.endswith('.NS') else f"{sym}.NS" for sym in raw_syms]
+        tickers = list(_load_tickers())
         
         print("Starting backtest...")
         # Run the backtest - use default API key in auto_backtest function
@@ -373,7 +650,8 @@ def backtest():
             tickers=tickers,
             total_cash=total_cash,
             size=size,
-            max_retries=3
+            max_retries=3,
+            idx_future=nifty500_future  # the Nifty 500 series doubles as the index filter
         )
         
         print("Getting stats...")
@@ -408,9 +686,9 @@ def backtest():
             trades['Return [%]'] = ((trades['Avg Exit Price'] - trades['Avg Entry Price']) / trades['Avg Entry Price']) * 100
         
         # Ensure return percentage is calculated correctly (handle any remaining zeros)
-        trades['Return [%]'] = trades.apply(lambda row: 
-            ((row['Avg Exit Price'] - row['Avg Entry Price']) / row['Avg Entry Price']) * 100 
-            if row['Avg Entry Price'] != 0 else 0, axis=1)
+        entry = trades['Avg Entry Price'].to_numpy()
+        exit_ = trades['Avg Exit Price'].to_numpy()
+        trades['Return [%]'] = np.where(entry != 0, (exit_ - entry) / np.where(entry == 0, 1, entry) * 100, 0.0)
         
         # Alternative: try different column names if the calculation seems wrong
         possible_return_cols = ['Return [%]', 'Return%', 'Return', 'Pct_Return']
@@ -424,21 +702,23 @@ def backtest():
         print("Sample calculated returns:", trades[['Avg Entry Price', 'Avg Exit Price', 'Return [%]']].head())
         
         # Sort trades by PnL to get best and worst
-        trades_sorted = trades.sort_values('PnL', ascending=False)
-        best_trades = trades_sorted.head(100).to_dict('records')
-        worst_trades = trades_sorted.tail(100).to_dict('records')
+        best_trades = frame_to_fragment(trades.nlargest(100, 'PnL'))
+        worst_trades = frame_to_fragment(trades.nsmallest(100, 'PnL'))
         
         # Calculate advanced metrics manually
         if len(trades) > 0:
             # Win rate calculation
-            winning_trades = len(trades[trades['PnL'] > 0])
-            losing_trades = len(trades[trades['PnL'] < 0])
+            pnl = trades['PnL'].to_numpy()
+            pos = pnl > 0
+            neg = pnl < 0
+            winning_trades = int(pos.sum())
+            losing_trades = int(neg.sum())
             total_trades = len(trades)
             win_rate_manual = (winning_trades / total_trades) * 100 if total_trades > 0 else 0
             
             # Profit factor calculation (Gross Profit / Gross Loss)
-            gross_profit = trades[trades['PnL'] > 0]['PnL'].sum() if winning_trades > 0 else 0
-            gross_loss = abs(trades[trades['PnL'] < 0]['PnL'].sum()) if losing_trades > 0 else 1
+            gross_profit = float(pnl[pos].sum())
+            gross_loss = float(-pnl[neg].sum()) if losing_trades > 0 else 1
             profit_factor = gross_profit / gross_loss if gross_loss > 0 else 0
             
         else:
@@ -452,14 +732,14 @@ def backtest():
         print(f"Profit factor: {profit_factor:.2f}")
         
         # Get benchmark data (Nifty 50 and Nifty 500)
-        print("Fetching benchmark data...")
-        nifty50_data = yf.download('^NSEI', period='24mo', interval='1d', progress=False)
-        nifty500_data = yf.download('^CRSLDX', period='24mo', interval='1d', progress=False)
+        print("Waiting for benchmark data...")
+        nifty50_data = nifty50_future.result()
+        nifty500_data = nifty500_future.result()
         
         # Align benchmark data with portfolio dates
         portfolio_dates = portfolio.value().index
-        nifty50_aligned = nifty50_data['Close'].reindex(portfolio_dates).ffill()
-        nifty500_aligned = nifty500_data['Close'].reindex(portfolio_dates).ffill()
+        nifty50_aligned = _close_series(nifty50_data, '^NSEI').reindex(portfolio_dates, method='ffill')
+        nifty500_aligned = _close_series(nifty500_data, '^CRSLDX').reindex(portfolio_dates, method='ffill')
         
         # Normalize benchmarks to same starting value as portfolio for comparison
         portfolio_values = portfolio.value()
@@ -480,7 +760,7 @@ def backtest():
                 if pd.isna(value) or value == float('inf') or value == float('-inf'):
                     return default
                 return f"{float(value):.2f}"
-            except:
+            except (TypeError, ValueError):
                 return default
         
         # Debug: Print available stats keys
@@ -498,43 +778,31 @@ def backtest():
         
         print("Generating plots...")
         # Generate value plot using matplotlib directly
-        plt.figure(figsize=(12, 6))
-        portfolio.value().plot(title='Portfolio Value', figsize=(12, 6))
-        plt.grid(True)
-        plt.tight_layout()
-        value_fig = plt.gcf()
-        value_img = fig_to_base64(value_fig)
-        plt.close(value_fig)
+        value_plot_url = store_plot(fig_to_png(portfolio.value(), 'Portfolio Value'))
         
         # Generate drawdowns plot using matplotlib directly
-        plt.figure(figsize=(12, 6))
-        portfolio.drawdown().plot(title='Portfolio Drawdowns', figsize=(12, 6), color='red')
-        plt.grid(True)
-        plt.tight_layout()
-        dd_fig = plt.gcf()
-        dd_img = fig_to_base64(dd_fig)
-        plt.close(dd_fig)
+        dd_plot_url = store_plot(fig_to_png(portfolio.drawdown(), 'Portfolio Drawdowns', color='red'))
         print(portfolio.trades.records_readable)
         print("Sending response...")
-        return jsonify({
+        return json_response({
             'status': 'success',
             'stats': stats_dict,
-            'value_plot': value_img,
-            'drawdowns_plot': dd_img,
+            'value_plot_url': value_plot_url,
+            'drawdowns_plot_url': dd_plot_url,
             'best_trades': best_trades,
             'worst_trades': worst_trades,
             'portfolio_data': {
-                'dates': [d.strftime('%Y-%m-%d') for d in portfolio_values.index],
-                'values': portfolio_values.values.tolist()
+                'dates': portfolio_values.index.strftime('%Y-%m-%d').tolist(),
+                'values': portfolio_values.values
             },
             'benchmark_data': {
                 'nifty50': {
-                    'dates': [d.strftime('%Y-%m-%d') for d in nifty50_normalized.index],
-                    'values': nifty50_normalized.values.tolist()
+                    'dates': nifty50_normalized.index.strftime('%Y-%m-%d').tolist(),
+                    'values': nifty50_normalized.values
                 },
                 'nifty500': {
-                    'dates': [d.strftime('%Y-%m-%d') for d in nifty500_normalized.index],
-                    'values': nifty500_normalized.values.tolist()
+                    'dates': nifty500_normalized.index.strftime('%Y-%m-%d').tolist(),
+                    'values': nifty500_normalized.values
                 }
             }
         })
@@ -543,11 +811,11 @@ def backtest():
         traceback_str = traceback.format_exc()
         print(f"Error: {str(e)}")
         print(traceback_str)
-        return jsonify({
+        return json_response({
             'status': 'error',
             'message': str(e),
             'traceback': traceback_str
-        }), 500
+        }, status=500)
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5000, debug=True, use_reloader=False, threaded=True) 
\ No newline at end of file
@@ -0,0 +1,5 @@
+"""WSGI entry point for running the backtester under a production server.
+
+    gunicorn -k gthread -w 2 --threads 8 --timeout 300 wsgi:app
+"""
+from app import app